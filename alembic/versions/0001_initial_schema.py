@@ -0,0 +1,45 @@
+"""Initial schema: the users table as first created by create_all
+
+Databases that already have the table (it used to be created at app startup)
+are left untouched, so `alembic upgrade head` works on them without a stamp.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-15 06:31:52
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table("users"):
+        return
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("username", sa.String(50), nullable=False),
+        sa.Column("email", sa.String(255), nullable=False),
+        sa.Column("hashed_password", sa.String(255), nullable=False),
+        sa.Column("github_username", sa.String(255), nullable=True),
+        sa.Column("github_repo", sa.String(255), nullable=True),
+        sa.Column("github_token", sa.String(255), nullable=True),
+        sa.Column("openai_token", sa.String(255), nullable=True),
+        sa.Column("refresh_token", sa.String(255), nullable=True, unique=True),
+        sa.Column("refresh_token_expiry", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_username", "users", ["username"], unique=True)
+    op.create_index("ix_users_email", "users", ["email"], unique=True)
+
+
+def downgrade():
+    op.drop_table("users")
@@ -0,0 +1,120 @@
+"""Bring users up to the current column types, constraints and indexes
+
+- refresh_token: VARCHAR(255) holding the token -> BYTEA holding its SHA-256
+  digest. Stored tokens are rehashed in place, so live sessions survive.
+- id: INTEGER serial -> BIGINT identity, without the redundant ix_users_id.
+- email: CITEXT with a 254-character check; username: unique constraint plus
+  a text_pattern_ops index.
+- created_at/updated_at: TIMESTAMPTZ defaulting to now().
+- hashed_password: VARCHAR(60); refresh token pair check and the partial
+  covering unique index; fillfactor 70.
+
+PostgreSQL only. Other databases are only used for development and get the
+current schema from create_all.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-15 07:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql":
+        raise NotImplementedError("users migrations are only written for PostgreSQL")
+    columns = {column["name"]: column["type"] for column in sa.inspect(bind).get_columns("users")}
+    if isinstance(columns["refresh_token"], sa.LargeBinary):
+        # Table was created by create_all from the current models
+        return
+
+    # The token and its expiry must be set together (ck_users_refresh_pair)
+    op.execute(
+        "UPDATE users SET refresh_token = NULL, refresh_token_expiry = NULL "
+        "WHERE (refresh_token IS NULL) <> (refresh_token_expiry IS NULL)"
+    )
+    op.drop_constraint("users_refresh_token_key", "users", type_="unique")
+    # Same digest as hash_refresh_token(); tokens are ASCII
+    op.execute(
+        "ALTER TABLE users ALTER COLUMN refresh_token TYPE BYTEA "
+        "USING sha256(convert_to(refresh_token, 'UTF8'))"
+    )
+
+    op.drop_index("ix_users_id", table_name="users")
+    op.execute("ALTER TABLE users ALTER COLUMN id DROP DEFAULT")
+    op.execute("DROP SEQUENCE users_id_seq")
+    op.execute("ALTER TABLE users ALTER COLUMN id TYPE BIGINT")
+    op.execute("ALTER TABLE users ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY")
+    op.execute("SELECT setval(pg_get_serial_sequence('users', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM users")
+
+    # Fails if two addresses differ only in case; those accounts must be
+    # merged by hand first
+    op.execute("CREATE EXTENSION IF NOT EXISTS citext")
+    op.drop_index("ix_users_email", table_name="users")
+    op.execute("ALTER TABLE users ALTER COLUMN email TYPE CITEXT")
+    op.create_unique_constraint("users_email_key", "users", ["email"])
+    op.create_check_constraint("ck_users_email_length", "users", "length(email) <= 254")
+
+    op.drop_index("ix_users_username", table_name="users")
+    op.create_unique_constraint("uq_users_username", "users", ["username"])
+    op.create_index("ix_users_username_pattern", "users", ["username"], postgresql_ops={"username": "text_pattern_ops"})
+
+    # bcrypt hashes are always 60 characters; PostgreSQL rejects the change
+    # if any stored value is longer
+    op.alter_column("users", "hashed_password", type_=sa.String(60))
+
+    # Old timestamps were naive UTC from datetime.utcnow
+    for name in ("created_at", "updated_at"):
+        op.execute(f"ALTER TABLE users ALTER COLUMN {name} TYPE TIMESTAMPTZ USING {name} AT TIME ZONE 'UTC'")
+        op.execute(f"UPDATE users SET {name} = now() WHERE {name} IS NULL")
+        op.alter_column("users", name, server_default=sa.func.now(), nullable=False)
+
+    op.create_check_constraint("ck_users_refresh_pair", "users", "(refresh_token IS NULL) = (refresh_token_expiry IS NULL)")
+    op.create_index(
+        "uq_users_refresh_token_active", "users", ["refresh_token"],
+        unique=True,
+        postgresql_include=["refresh_token_expiry", "id"],
+        postgresql_where=sa.text("refresh_token IS NOT NULL"),
+    )
+    op.execute("ALTER TABLE users SET (fillfactor = 70)")
+
+
+def downgrade():
+    op.execute("ALTER TABLE users RESET (fillfactor)")
+    op.drop_index("uq_users_refresh_token_active", table_name="users")
+    op.drop_constraint("ck_users_refresh_pair", "users", type_="check")
+
+    for name in ("created_at", "updated_at"):
+        op.alter_column("users", name, server_default=None, nullable=True)
+        op.execute(f"ALTER TABLE users ALTER COLUMN {name} TYPE TIMESTAMP USING {name} AT TIME ZONE 'UTC'")
+
+    op.alter_column("users", "hashed_password", type_=sa.String(255))
+
+    op.drop_index("ix_users_username_pattern", table_name="users")
+    op.drop_constraint("uq_users_username", "users", type_="unique")
+    op.create_index("ix_users_username", "users", ["username"], unique=True)
+
+    op.drop_constraint("ck_users_email_length", "users", type_="check")
+    op.drop_constraint("users_email_key", "users", type_="unique")
+    op.execute("ALTER TABLE users ALTER COLUMN email TYPE VARCHAR(255)")
+    op.create_index("ix_users_email", "users", ["email"], unique=True)
+
+    op.execute("ALTER TABLE users ALTER COLUMN id DROP IDENTITY")
+    op.execute("ALTER TABLE users ALTER COLUMN id TYPE INTEGER")
+    op.execute("CREATE SEQUENCE users_id_seq OWNED BY users.id")
+    op.execute("SELECT setval('users_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM users")
+    op.execute("ALTER TABLE users ALTER COLUMN id SET DEFAULT nextval('users_id_seq')")
+    op.create_index("ix_users_id", "users", ["id"])
+
+    # Digests cannot be turned back into tokens, so sessions end here
+    op.execute("UPDATE users SET refresh_token = NULL, refresh_token_expiry = NULL")
+    op.execute("ALTER TABLE users ALTER COLUMN refresh_token TYPE VARCHAR(255) USING NULL")
+    op.create_unique_constraint("users_refresh_token_key", "users", ["refresh_token"])
@@ -0,0 +1,72 @@
+"""Move GitHub/OpenAI credentials from users into user_secrets
+
+Copies every user's saved credentials into user_secrets, then drops the old
+columns. user_secrets may already exist if the new backend started before
+this ran (create_all creates missing tables); rows saved there since are
+kept over the copies.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-15 07:10:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+SECRET_COLUMNS = ("github_username", "github_repo", "github_token", "openai_token")
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if not inspector.has_table("user_secrets"):
+        op.create_table(
+            "user_secrets",
+            sa.Column("user_id", sa.BigInteger(), sa.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+            sa.Column("github_username", sa.String(39), nullable=True),
+            sa.Column("github_repo", sa.String(100), nullable=True),
+            sa.Column("github_token", sa.String(255), nullable=True),
+            sa.Column("openai_token", sa.String(255), nullable=True),
+        )
+    if "github_token" not in {column["name"] for column in inspector.get_columns("users")}:
+        # users was created from the current models; nothing to move
+        return
+
+    # user_secrets is narrower than the old columns (GitHub allows 39-char
+    # logins and 100-char repo names); stop rather than truncate
+    too_long = bind.execute(sa.text(
+        "SELECT count(*) FROM users WHERE length(github_username) > 39 OR length(github_repo) > 100"
+    )).scalar()
+    if too_long:
+        raise RuntimeError(
+            f"{too_long} user(s) have a github_username over 39 or a github_repo over 100 "
+            "characters; fix or clear them before upgrading"
+        )
+
+    # Users with nothing saved get their row on first use (get_user_secrets)
+    columns = ", ".join(SECRET_COLUMNS)
+    op.execute(
+        f"INSERT INTO user_secrets (user_id, {columns}) "
+        f"SELECT id, {columns} FROM users "
+        f"WHERE {' OR '.join(f'{name} IS NOT NULL' for name in SECRET_COLUMNS)} "
+        "ON CONFLICT (user_id) DO NOTHING"
+    )
+    for name in SECRET_COLUMNS:
+        op.drop_column("users", name)
+
+
+def downgrade():
+    for name in SECRET_COLUMNS:
+        op.add_column("users", sa.Column(name, sa.String(255), nullable=True))
+    op.execute(
+        "UPDATE users SET "
+        + ", ".join(f"{name} = s.{name}" for name in SECRET_COLUMNS)
+        + " FROM user_secrets s WHERE s.user_id = users.id"
+    )
+    op.drop_table("user_secrets")
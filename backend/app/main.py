@@ -1,20 +1,34 @@
-import base64
+import asyncio
+import pybase64
+import hashlib
+import heapq
+import hmac
 import httpx
+import operator
+from array import array
+from cachetools import LRUCache, TTLCache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from fastapi import FastAPI, HTTPException, Depends, Response, Request, Cookie, UploadFile, File
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr, constr
 from typing import List, Optional
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 import bcrypt
 import jwt
 import secrets
 import os
+import re
+import time
 import io
+import multiprocessing
+import tarfile
+import tempfile
 from PIL import Image
-import json
+import orjson
 
-from backend.app.database import SessionLocal, engine, Base
+from backend.app.database import SessionLocal, engine, Base, create_tables
 from backend.app import models
 
 app = FastAPI()
@@ -24,18 +38,122 @@ JWT_SECRET = os.getenv("JWT_SECRET", "supersecretjwtkey")
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 15
 REFRESH_TOKEN_EXPIRE_DAYS = 7
+_jwt = jwt.PyJWT()
+_jwt_key = JWT_SECRET.encode("utf-8")
+# Verified access tokens -> payload; "exp" is re-checked on every hit
+_access_token_cache = TTLCache(maxsize=10_000, ttl=30)
+
+# bcrypt settings
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# bcrypt releases the GIL, so a pool sized to the CPU count hashes in parallel
+# without tying up the event loop or the default threadpool
+_bcrypt_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+# Recently verified logins: email -> (credential digest, user id), so rapid
+# repeat logins skip bcrypt. Digests are keyed with a per-process secret and
+# never leave this process.
+_login_cache = TTLCache(maxsize=10_000, ttl=30)
+_login_cache_key = secrets.token_bytes(32)
 
 GITHUB_API_URL = "https://api.github.com"
-OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_API_URL = "https://api.openai.com/v1"
+OPENAI_MODEL = "gpt-4o"  # must accept image_url content parts
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+OPENAI_CONCURRENCY = 4  # max in-flight embedding requests per ask
+RETRIEVAL_TOP_K = 8  # repo files sent to the chat model per ask
+EMBEDDING_BATCH_SIZE = 32  # inputs per embeddings request
+# Inputs are capped in UTF-8 bytes: a byte-level BPE token covers at least one
+# byte, so this keeps even CJK or dense data under the 8191-token model limit
+EMBEDDING_MAX_BYTES = 8000
+# Bound once so the per-file loop in /ask does no format-spec parsing
+PROMPT_FILE_TEMPLATE = "File: %s\nContent:\n%s\n---\n".__mod__
+# Max in-flight blob POSTs per commit; content-creating requests count harder
+# against GitHub's secondary rate limits than reads
+GITHUB_BLOB_CONCURRENCY = 10
+# Blobs above this size, or with control characters that JSON would escape as
+# \uXXXX, are sent base64-encoded
+BLOB_BASE64_THRESHOLD = 64 * 1024
+_BLOB_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+TARBALL_SPOOL_SIZE = 8 * 1024 * 1024  # repo archives larger than this spill to disk
+# Repo files sent to the model: source/text files under 200KB, outside
+# dependency and build output directories
+MAX_REPO_FILE_SIZE = 200_000
+TEXT_FILE_EXTENSIONS = {
+    ".py", ".js", ".jsx", ".ts", ".tsx", ".md", ".json", ".yaml", ".yml", ".toml", ".ini", ".cfg",
+    ".html", ".css", ".txt", ".sh", ".sql", ".go", ".rs", ".java", ".c", ".cpp", ".h",
+}
+TEXT_FILE_NAMES = {"Dockerfile", "Makefile"}
+SKIPPED_REPO_DIRS = {"node_modules", "dist", "__pycache__"}
+MAX_UPLOAD_IMAGE_SIZE = 50 * 1024  # encoded size budget per uploaded image
+
+# Shared HTTP clients (one connection pool per upstream, reused across requests)
+
+@app.on_event("startup")
+async def startup_http_clients():
+    limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
+    app.state.gh_client = httpx.AsyncClient(base_url=GITHUB_API_URL, http2=True, limits=limits)
+    app.state.openai_client = httpx.AsyncClient(base_url=OPENAI_API_URL, http2=True, limits=limits, timeout=60)
+
+@app.on_event("shutdown")
+async def shutdown_http_clients():
+    await app.state.gh_client.aclose()
+    await app.state.openai_client.aclose()
+
+# PIL holds the GIL for much of decode/resize/encode, so uploads are processed
+# in separate processes. Workers come from a forkserver rather than a fork of
+# this process, which already runs executor threads and the event loop.
+
+@app.on_event("startup")
+async def startup_image_pool():
+    app.state.image_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver"))
+
+@app.on_event("shutdown")
+async def shutdown_image_pool():
+    app.state.image_pool.shutdown(cancel_futures=True)
+
+@app.on_event("startup")
+async def startup_database():
+    await create_tables()
+
+@app.on_event("shutdown")
+async def shutdown_database():
+    await engine.dispose()
 
 # Dependency
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+def get_github_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.gh_client
+
+def get_openai_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.openai_client
+
+def get_image_pool(request: Request) -> ProcessPoolExecutor:
+    return request.app.state.image_pool
+
+# GitHub metadata caches. Keys carry a digest of the token so a cached answer
+# is never served to a caller with different credentials.
+
+_branch_cache = TTLCache(maxsize=1024, ttl=300)  # key -> default branch
+_tree_cache = LRUCache(maxsize=1024)  # key + (branch,) -> (etag, files)
+# In-flight tree fetches; entries are removed as soon as the fetch finishes
+_tree_requests: dict = {}
+# Single-flight lock per cache key. Bounded: evicting an idle key's lock only
+# costs coalescing for that key, never correctness.
+_cache_locks = LRUCache(maxsize=4096)
+# (user, repo, path, git blob sha) -> embedding; float32 arrays keep each entry ~6KB
+_embedding_cache = LRUCache(maxsize=10_000)
+
+def github_cache_key(config: "GitHubConfig") -> tuple:
+    return (config.username, config.repo, hashlib.sha256(config.token.encode("utf-8")).hexdigest())
+
+def cache_lock(key: tuple) -> asyncio.Lock:
+    lock = _cache_locks.get(key)
+    if lock is None:
+        lock = _cache_locks[key] = asyncio.Lock()
+    return lock
 
 # Pydantic models
 
@@ -56,11 +174,13 @@ class TokenPayload(BaseModel):
     sub: int
     exp: int
 
+# Limits match the user_secrets column widths, so overlong values get a 422
+# instead of a database error
 class GitHubConfigUpdate(BaseModel):
-    github_username: Optional[str]
-    github_repo: Optional[str]
-    github_token: Optional[str]
-    openai_token: Optional[str]
+    github_username: Optional[constr(max_length=39)]
+    github_repo: Optional[constr(max_length=100)]
+    github_token: Optional[constr(max_length=255)]
+    openai_token: Optional[constr(max_length=255)]
 
 class GitHubConfig(BaseModel):
     username: str
@@ -89,40 +209,57 @@ class AskResponse(BaseModel):
 
 # Utility functions
 
-def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+async def hash_password(password: str) -> str:
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    loop = asyncio.get_running_loop()
+    hashed = await loop.run_in_executor(_bcrypt_pool, bcrypt.hashpw, password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bcrypt_pool, bcrypt.checkpw, plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+def login_digest(email: str, password: str) -> bytes:
+    return hashlib.blake2b(f"{email}\0{password}".encode('utf-8'), key=_login_cache_key, digest_size=16).digest()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta if expires_delta else timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    encoded_jwt = _jwt.encode(to_encode, _jwt_key, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
 def create_refresh_token():
     # Generate a secure random string
     return secrets.token_urlsafe(32)
 
+def hash_refresh_token(token: str) -> bytes:
+    # Only the digest is stored, so a database leak exposes no usable tokens
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+def decode_access_token(token: str) -> dict:
+    payload = _access_token_cache.get(token)
+    if payload is not None and payload["exp"] > time.time():
+        return payload
+    payload = _jwt.decode(token, _jwt_key, algorithms=[JWT_ALGORITHM])
+    _access_token_cache[token] = payload
+    return payload
+
 def verify_access_token(token: str):
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = decode_access_token(token)
         return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Access token expired")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid access token")
 
-async def get_current_user(request: Request, db: Session = Depends(get_db)) -> models.User:
+async def get_current_user(request: Request, db: AsyncSession = Depends(get_db)) -> models.User:
     token = request.cookies.get("access_token")
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = decode_access_token(token)
         user_id: int = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token payload")
@@ -130,38 +267,59 @@ async def get_current_user(request: Request, db: Session = Depends(get_db)) -> m
         raise HTTPException(status_code=401, detail="Access token expired")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    # Primary-key lookup checks the identity map before emitting SQL
+    user = await db.get(models.User, user_id)
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
+async def get_user_secrets(current_user: models.User = Depends(get_current_user)) -> models.UserSecrets:
+    # Loaded only by endpoints that need GitHub/OpenAI credentials; auth-only
+    # requests never touch the user_secrets table
+    user_secrets = await current_user.awaitable_attrs.secrets
+    if user_secrets is None:
+        user_secrets = models.UserSecrets(user_id=current_user.id)
+    return user_secrets
+
 # Auth endpoints
 
 @app.post("/signup", status_code=201)
-def signup(user: UserCreate, db: Session = Depends(get_db)):
-    existing_user = db.query(models.User).filter(models.User.email == user.email).first()
+async def signup(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    existing_user = (await db.execute(select(models.User).where(models.User.email == user.email))).scalar_one_or_none()
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = hash_password(user.password)
+    hashed_password = await hash_password(user.password)
     db_user = models.User(username=user.username, email=user.email, hashed_password=hashed_password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return {"msg": "User created successfully"}
 
 @app.post("/login", response_model=TokenResponse)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), response: Response = None, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
-        raise HTTPException(status_code=401, detail="Incorrect email or password")
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), response: Response = None, db: AsyncSession = Depends(get_db)):
+    user_id = None
+    digest = login_digest(form_data.username, form_data.password)
+    cached = _login_cache.get(form_data.username)
+    if cached is not None and hmac.compare_digest(cached[0], digest):
+        user_id = cached[1]
+    if user_id is None:
+        login_row = await models.load_login_row(db, form_data.username)
+        if not login_row or not await verify_password(form_data.password, login_row.hashed_password):
+            raise HTTPException(status_code=401, detail="Incorrect email or password")
+        user_id = login_row.id
+        _login_cache[form_data.username] = (digest, user_id)
 
-    access_token = create_access_token({"sub": user.id})
     refresh_token = create_refresh_token()
 
     # Save refresh token in DB
-    user.refresh_token = refresh_token
-    user.refresh_token_expiry = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    db.commit()
+    token_hash = hash_refresh_token(refresh_token)
+    expiry = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    if not await models.store_refresh_token(db, user_id, token_hash, expiry):
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
+    await db.commit()
+    models.cache_put(token_hash, user_id, expiry)
+
+    access_token = create_access_token({"sub": user_id})
 
     # Set cookies
     response.set_cookie(
@@ -186,11 +344,10 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), response: Response =
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/logout")
-def logout(response: Response, current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def logout(response: Response, current_user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     # Remove refresh token from DB
-    current_user.refresh_token = None
-    current_user.refresh_token_expiry = None
-    db.commit()
+    await models.User.invalidate_refresh(db, current_user.id)
+    await db.commit()
 
     # Remove cookies
     response.delete_cookie("access_token", path="/")
@@ -199,27 +356,32 @@ def logout(response: Response, current_user: models.User = Depends(get_current_u
     return {"msg": "Logged out successfully"}
 
 @app.post("/refresh", response_model=TokenResponse)
-def refresh_token(response: Response, refresh_token: Optional[str] = Cookie(None), db: Session = Depends(get_db)):
+async def refresh_token(response: Response, refresh_token: Optional[str] = Cookie(None), db: AsyncSession = Depends(get_db)):
     if not refresh_token:
         raise HTTPException(status_code=401, detail="Refresh token missing")
 
-    user = db.query(models.User).filter(models.User.refresh_token == refresh_token).first()
-    if not user:
+    token_hash = hash_refresh_token(refresh_token)
+    auth = models.cache_get(token_hash) or await models.load_auth_row(db, token_hash)
+    if not auth:
         raise HTTPException(status_code=401, detail="Invalid refresh token")
 
-    if user.refresh_token_expiry < datetime.utcnow():
-        user.refresh_token = None
-        user.refresh_token_expiry = None
-        db.commit()
+    if auth.refresh_token_expiry < datetime.utcnow():
+        models.cache_invalidate(token_hash)
+        await models.store_refresh_token(db, auth.id, None, None, current_hash=token_hash)
+        await db.commit()
         raise HTTPException(status_code=401, detail="Refresh token expired")
 
     # Rotate refresh token
     new_refresh_token = create_refresh_token()
-    user.refresh_token = new_refresh_token
-    user.refresh_token_expiry = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    db.commit()
+    new_token_hash = hash_refresh_token(new_refresh_token)
+    expiry = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    models.cache_invalidate(token_hash)
+    if not await models.store_refresh_token(db, auth.id, new_token_hash, expiry, current_hash=token_hash):
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    await db.commit()
+    models.cache_put(new_token_hash, auth.id, expiry)
 
-    access_token = create_access_token({"sub": user.id})
+    access_token = create_access_token({"sub": auth.id})
 
     # Set cookies
     response.set_cookie(
@@ -246,280 +408,410 @@ def refresh_token(response: Response, refresh_token: Optional[str] = Cookie(None
 # GitHub config endpoints
 
 @app.get("/user/github-config")
-def get_github_config(current_user: models.User = Depends(get_current_user)):
+async def get_github_config(user_secrets: models.UserSecrets = Depends(get_user_secrets)):
     return {
-        "github_username": current_user.github_username,
-        "github_repo": current_user.github_repo,
-        "github_token": current_user.github_token,
-        "openai_token": current_user.openai_token
+        "github_username": user_secrets.github_username,
+        "github_repo": user_secrets.github_repo,
+        "github_token": user_secrets.github_token,
+        "openai_token": user_secrets.openai_token
     }
 
 @app.post("/user/github-config")
-def update_github_config(config: GitHubConfigUpdate, current_user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def update_github_config(config: GitHubConfigUpdate, user_secrets: models.UserSecrets = Depends(get_user_secrets), db: AsyncSession = Depends(get_db)):
     if config.github_username is not None:
-        current_user.github_username = config.github_username
+        user_secrets.github_username = config.github_username
     if config.github_repo is not None:
-        current_user.github_repo = config.github_repo
+        user_secrets.github_repo = config.github_repo
     if config.github_token is not None:
-        current_user.github_token = config.github_token
+        user_secrets.github_token = config.github_token
     if config.openai_token is not None:
-        current_user.openai_token = config.openai_token
-    db.commit()
+        user_secrets.openai_token = config.openai_token
+    db.add(user_secrets)
+    await db.commit()
     return {"msg": "GitHub and OpenAI tokens updated"}
 
 # GitHub API endpoints (reuse existing code, but require auth and use stored tokens)
 
-async def get_default_branch(config: GitHubConfig):
+async def fetch_default_branch(config: GitHubConfig, client: httpx.AsyncClient):
     headers = {"Authorization": f"token {config.token}"}
-    url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}"
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url, headers=headers)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=f"Repo not found or unauthorized")
-        data = resp.json()
-        default_branch = data.get("default_branch")
-        if not default_branch:
-            # fallback to main or master
-            # check if main exists
-            for branch in ["main", "master"]:
-                branch_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/branches/{branch}"
-                branch_resp = await client.get(branch_url, headers=headers)
-                if branch_resp.status_code == 200:
-                    return branch
-            raise HTTPException(status_code=404, detail="No default branch found")
-        return default_branch
+    url = f"/repos/{config.username}/{config.repo}"
+    resp = await client.get(url, headers=headers)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=f"Repo not found or unauthorized")
+    data = orjson.loads(resp.content)
+    default_branch = data.get("default_branch")
+    if not default_branch:
+        # fallback to main or master
+        # check if main exists
+        for branch in ["main", "master"]:
+            branch_url = f"/repos/{config.username}/{config.repo}/branches/{branch}"
+            branch_resp = await client.get(branch_url, headers=headers)
+            if branch_resp.status_code == 200:
+                return branch
+        raise HTTPException(status_code=404, detail="No default branch found")
+    return default_branch
+
+async def get_default_branch(config: GitHubConfig, client: httpx.AsyncClient):
+    key = github_cache_key(config)
+    branch = _branch_cache.get(key)
+    if branch is not None:
+        return branch
+    # Concurrent misses for the same repo wait on a single lookup
+    async with cache_lock(key):
+        branch = _branch_cache.get(key)
+        if branch is None:
+            branch = await fetch_default_branch(config, client)
+            _branch_cache[key] = branch
+        return branch
+
+async def fetch_repo_tree(config: GitHubConfig, client: httpx.AsyncClient, branch: str, key: tuple) -> List[str]:
+    headers = {"Authorization": f"token {config.token}"}
+    url = f"/repos/{config.username}/{config.repo}/git/trees/{branch}?recursive=1"
+    cached = _tree_cache.get(key)
+    if cached:
+        # Conditional request: GitHub answers 304 (not rate limited) if unchanged
+        headers["If-None-Match"] = cached[0]
+    resp = await client.get(url, headers=headers)
+    if resp.status_code == 304 and cached:
+        return cached[1]
+    if resp.status_code == 404:
+        return []
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail="Failed to fetch repo tree")
+    data = orjson.loads(resp.content)
+    tree = data.get("tree", [])
+    files = [item["path"] for item in tree if item["type"] == "blob"]
+    etag = resp.headers.get("ETag")
+    if etag:
+        _tree_cache[key] = (etag, files)
+    return files
 
 @app.post("/github/tree")
-async def get_repo_tree(current_user: models.User = Depends(get_current_user)):
-    if not current_user.github_username or not current_user.github_repo or not current_user.github_token:
+async def get_repo_tree(user_secrets: models.UserSecrets = Depends(get_user_secrets), client: httpx.AsyncClient = Depends(get_github_client)):
+    if not user_secrets.github_username or not user_secrets.github_repo or not user_secrets.github_token:
         raise HTTPException(status_code=400, detail="GitHub configuration incomplete")
-    config = GitHubConfig(username=current_user.github_username, repo=current_user.github_repo, token=current_user.github_token)
-    headers = {"Authorization": f"token {config.token}"}
-    default_branch = await get_default_branch(config)
-    url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/git/trees/{default_branch}?recursive=1"
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url, headers=headers)
-        if resp.status_code == 404:
-            return {"files": []}
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail="Failed to fetch repo tree")
-        data = resp.json()
-        tree = data.get("tree", [])
-        files = [item["path"] for item in tree if item["type"] == "blob"]
-        return {"files": files}
+    config = GitHubConfig(username=user_secrets.github_username, repo=user_secrets.github_repo, token=user_secrets.github_token)
+    default_branch = await get_default_branch(config, client)
+    key = github_cache_key(config) + (default_branch,)
+    # Concurrent calls for the same tree share one in-flight GET; shield keeps a
+    # cancelled caller from cancelling it for the others
+    task = _tree_requests.get(key)
+    if task is None:
+        task = _tree_requests[key] = asyncio.ensure_future(fetch_repo_tree(config, client, default_branch, key))
+        task.add_done_callback(lambda _: _tree_requests.pop(key, None))
+    files = await asyncio.shield(task)
+    return {"files": files}
 
 @app.post("/github/file")
-async def get_file_content(path: str, current_user: models.User = Depends(get_current_user)):
-    if not current_user.github_username or not current_user.github_repo or not current_user.github_token:
+async def get_file_content(path: str, user_secrets: models.UserSecrets = Depends(get_user_secrets), client: httpx.AsyncClient = Depends(get_github_client)):
+    if not user_secrets.github_username or not user_secrets.github_repo or not user_secrets.github_token:
         raise HTTPException(status_code=400, detail="GitHub configuration incomplete")
-    config = GitHubConfig(username=current_user.github_username, repo=current_user.github_repo, token=current_user.github_token)
+    config = GitHubConfig(username=user_secrets.github_username, repo=user_secrets.github_repo, token=user_secrets.github_token)
     headers = {"Authorization": f"token {config.token}"}
-    url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/contents/{path}"
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url, headers=headers)
+    # Raw media type returns the file bytes directly instead of base64 in JSON
+    headers["Accept"] = "application/vnd.github.raw"
+    url = f"/repos/{config.username}/{config.repo}/contents/{path}"
+    async with client.stream("GET", url, headers=headers) as resp:
         if resp.status_code == 404:
             raise HTTPException(status_code=404, detail="File not found")
         if resp.status_code != 200:
             raise HTTPException(status_code=resp.status_code, detail="Failed to fetch file content")
-        data = resp.json()
-        content_b64 = data.get("content", "")
-        encoding = data.get("encoding", "")
-        if encoding != "base64":
-            raise HTTPException(status_code=500, detail="Unsupported encoding")
-        content = base64.b64decode(content_b64).decode("utf-8")
-        return {"path": path, "content": content}
+        buf = bytearray()
+        async for chunk in resp.aiter_bytes(chunk_size=65536):
+            buf += chunk
+    try:
+        content = buf.decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=500, detail="Unsupported encoding")
+    return {"path": path, "content": content}
+
+def blob_payload(content: str) -> dict:
+    data = content.encode("utf-8")
+    if len(data) > BLOB_BASE64_THRESHOLD or _BLOB_CONTROL_CHARS.search(content):
+        return {"content": pybase64.b64encode(data).decode("ascii"), "encoding": "base64"}
+    return {"content": content, "encoding": "utf-8"}
 
 @app.post("/github/commit")
-async def commit_changes(commit_req: CommitRequest, current_user: models.User = Depends(get_current_user)):
-    if not current_user.github_username or not current_user.github_repo or not current_user.github_token:
+async def commit_changes(commit_req: CommitRequest, user_secrets: models.UserSecrets = Depends(get_user_secrets), client: httpx.AsyncClient = Depends(get_github_client)):
+    if not user_secrets.github_username or not user_secrets.github_repo or not user_secrets.github_token:
         raise HTTPException(status_code=400, detail="GitHub configuration incomplete")
-    config = GitHubConfig(username=current_user.github_username, repo=current_user.github_repo, token=current_user.github_token)
+    config = GitHubConfig(username=user_secrets.github_username, repo=user_secrets.github_repo, token=user_secrets.github_token)
     headers = {"Authorization": f"token {config.token}"}
-    async with httpx.AsyncClient() as client:
-        branch = commit_req.branch or await get_default_branch(config)
-        ref_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/git/ref/heads/{branch}"
-        ref_resp = await client.get(ref_url, headers=headers)
-        if ref_resp.status_code == 404:
-            ref = None
-        elif ref_resp.status_code != 200:
-            raise HTTPException(status_code=ref_resp.status_code, detail="Failed to get ref")
-        else:
-            ref = ref_resp.json()
-        if ref:
-            base_tree_sha = ref["object"]["sha"]
-        else:
-            base_tree_sha = None
-        blobs = []
-        for file in commit_req.files:
-            blob_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/git/blobs"
-            blob_data = {
-                "content": file.content,
-                "encoding": "utf-8"
-            }
-            blob_resp = await client.post(blob_url, headers=headers, json=blob_data)
-            if blob_resp.status_code != 201:
-                raise HTTPException(status_code=blob_resp.status_code, detail="Failed to create blob")
-            blob_sha = blob_resp.json()["sha"]
-            blobs.append({"path": file.path, "mode": "100644", "type": "blob", "sha": blob_sha})
-        tree_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/git/trees"
-        tree_data = {"tree": blobs}
-        if base_tree_sha:
-            tree_data["base_tree"] = base_tree_sha
-        tree_resp = await client.post(tree_url, headers=headers, json=tree_data)
-        if tree_resp.status_code != 201:
-            raise HTTPException(status_code=tree_resp.status_code, detail="Failed to create tree")
-        tree_sha = tree_resp.json()["sha"]
-        commit_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/git/commits"
-        parents = []
-        if ref:
-            parents.append(ref["object"]["sha"])
-        commit_data = {
-            "message": commit_req.message,
-            "tree": tree_sha,
-            "parents": parents
-        }
-        commit_resp = await client.post(commit_url, headers=headers, json=commit_data)
-        if commit_resp.status_code != 201:
-            raise HTTPException(status_code=commit_resp.status_code, detail="Failed to create commit")
-        commit_sha = commit_resp.json()["sha"]
-        if ref:
-            update_ref_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/git/refs/heads/{branch}"
-            update_data = {"sha": commit_sha}
-            update_resp = await client.patch(update_ref_url, headers=headers, json=update_data)
-            if update_resp.status_code != 200:
-                raise HTTPException(status_code=update_resp.status_code, detail="Failed to update ref")
-        else:
-            create_ref_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/git/refs"
-            create_data = {"ref": f"refs/heads/{branch}", "sha": commit_sha}
-            create_resp = await client.post(create_ref_url, headers=headers, json=create_data)
-            if create_resp.status_code != 201:
-                raise HTTPException(status_code=create_resp.status_code, detail="Failed to create ref")
-        return {"commit_sha": commit_sha}
+    branch = commit_req.branch or await get_default_branch(config, client)
+    ref_url = f"/repos/{config.username}/{config.repo}/git/ref/heads/{branch}"
+    ref_resp = await client.get(ref_url, headers=headers)
+    if ref_resp.status_code == 404:
+        ref = None
+    elif ref_resp.status_code != 200:
+        raise HTTPException(status_code=ref_resp.status_code, detail="Failed to get ref")
+    else:
+        ref = orjson.loads(ref_resp.content)
+    if ref:
+        base_tree_sha = ref["object"]["sha"]
+    else:
+        base_tree_sha = None
+    blob_url = f"/repos/{config.username}/{config.repo}/git/blobs"
+    sem = asyncio.Semaphore(GITHUB_BLOB_CONCURRENCY)
+
+    blob_headers = {**headers, "Content-Type": "application/json"}
+
+    async def create_blob(file: FileContent):
+        blob_data = blob_payload(file.content)
+        async with sem:
+            blob_resp = await client.post(blob_url, headers=blob_headers, content=orjson.dumps(blob_data))
+        if blob_resp.status_code != 201:
+            raise HTTPException(status_code=blob_resp.status_code, detail="Failed to create blob")
+        blob_sha = orjson.loads(blob_resp.content)["sha"]
+        return {"path": file.path, "mode": "100644", "type": "blob", "sha": blob_sha}
+
+    # gather preserves input order, so the tree entries match commit_req.files
+    blobs = await asyncio.gather(*(create_blob(file) for file in commit_req.files))
+    tree_url = f"/repos/{config.username}/{config.repo}/git/trees"
+    tree_data = {"tree": blobs}
+    if base_tree_sha:
+        tree_data["base_tree"] = base_tree_sha
+    tree_resp = await client.post(tree_url, headers=headers, json=tree_data)
+    if tree_resp.status_code != 201:
+        raise HTTPException(status_code=tree_resp.status_code, detail="Failed to create tree")
+    tree_sha = orjson.loads(tree_resp.content)["sha"]
+    commit_url = f"/repos/{config.username}/{config.repo}/git/commits"
+    parents = []
+    if ref:
+        parents.append(ref["object"]["sha"])
+    commit_data = {
+        "message": commit_req.message,
+        "tree": tree_sha,
+        "parents": parents
+    }
+    commit_resp = await client.post(commit_url, headers=headers, json=commit_data)
+    if commit_resp.status_code != 201:
+        raise HTTPException(status_code=commit_resp.status_code, detail="Failed to create commit")
+    commit_sha = orjson.loads(commit_resp.content)["sha"]
+    if ref:
+        update_ref_url = f"/repos/{config.username}/{config.repo}/git/refs/heads/{branch}"
+        update_data = {"sha": commit_sha}
+        update_resp = await client.patch(update_ref_url, headers=headers, json=update_data)
+        if update_resp.status_code != 200:
+            raise HTTPException(status_code=update_resp.status_code, detail="Failed to update ref")
+    else:
+        create_ref_url = f"/repos/{config.username}/{config.repo}/git/refs"
+        create_data = {"ref": f"refs/heads/{branch}", "sha": commit_sha}
+        create_resp = await client.post(create_ref_url, headers=headers, json=create_data)
+        if create_resp.status_code != 201:
+            raise HTTPException(status_code=create_resp.status_code, detail="Failed to create ref")
+    return {"commit_sha": commit_sha}
 
 # Helper to fetch repo files and contents
-async def fetch_repo_files_contents(config: GitHubConfig):
-    headers = {"Authorization": f"token {config.token}"}
-    default_branch = await get_default_branch(config)
-    tree_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/git/trees/{default_branch}?recursive=1"
-    async with httpx.AsyncClient() as client:
-        tree_resp = await client.get(tree_url, headers=headers)
-        if tree_resp.status_code != 200:
-            raise HTTPException(status_code=tree_resp.status_code, detail="Failed to fetch repo tree")
-        tree_data = tree_resp.json()
-        tree = tree_data.get("tree", [])
-        files = [item["path"] for item in tree if item["type"] == "blob"]
-
-        file_contents = {}
-        for path in files:
-            file_url = f"{GITHUB_API_URL}/repos/{config.username}/{config.repo}/contents/{path}"
-            file_resp = await client.get(file_url, headers=headers)
-            if file_resp.status_code != 200:
+def is_prompt_file(path: str) -> bool:
+    *dirs, name = path.split("/")
+    if SKIPPED_REPO_DIRS.intersection(dirs):
+        return False
+    return name in TEXT_FILE_NAMES or os.path.splitext(name)[1] in TEXT_FILE_EXTENSIONS
+
+def read_tarball_text_files(fileobj) -> dict:
+    file_contents = {}
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+        for member in tar:
+            if not member.isfile() or member.size > MAX_REPO_FILE_SIZE:
                 continue
-            file_data = file_resp.json()
-            content_b64 = file_data.get("content", "")
-            encoding = file_data.get("encoding", "")
-            if encoding != "base64":
+            # GitHub prefixes every entry with "<owner>-<repo>-<sha>/"
+            path = member.name.split("/", 1)[-1]
+            # Checked before extractfile so skipped members are never read
+            if not is_prompt_file(path):
+                continue
+            data = tar.extractfile(member).read()
+            # Skip binary files
+            if b"\0" in data:
                 continue
             try:
-                content = base64.b64decode(content_b64).decode("utf-8")
-            except Exception:
-                content = ""
-            file_contents[path] = content
-        return file_contents
-
-# Helper to convert uploaded images to low-res base64 strings
-async def process_uploaded_files(files: List[UploadFile]) -> List[str]:
-    processed_files = []
-    for file in files:
-        try:
-            contents = await file.read()
-            image = Image.open(io.BytesIO(contents))
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            # Resize to max width or height 300px preserving aspect ratio
-            max_size = (300, 300)
-            image.thumbnail(max_size, Image.ANTIALIAS)
-            # Save to bytes buffer with quality to keep size < 50KB
+                file_contents[path] = data.decode("utf-8")
+            except UnicodeDecodeError:
+                continue
+    return file_contents
+
+async def fetch_repo_files_contents(config: GitHubConfig, client: httpx.AsyncClient):
+    headers = {"Authorization": f"token {config.token}"}
+    default_branch = await get_default_branch(config, client)
+    tarball_url = f"/repos/{config.username}/{config.repo}/tarball/{default_branch}"
+    with tempfile.SpooledTemporaryFile(max_size=TARBALL_SPOOL_SIZE) as archive:
+        # The whole repo in one request; GitHub redirects to codeload.github.com
+        async with client.stream("GET", tarball_url, headers=headers, follow_redirects=True) as resp:
+            if resp.status_code != 200:
+                raise HTTPException(status_code=resp.status_code, detail="Failed to fetch repo tarball")
+            async for chunk in resp.aiter_bytes():
+                archive.write(chunk)
+        archive.seek(0)
+        # Decompression is CPU-bound, keep it off the event loop
+        return await asyncio.to_thread(read_tarball_text_files, archive)
+
+# Helpers to pick the repo files most relevant to a prompt via embeddings
+def git_blob_sha(content: str) -> str:
+    data = content.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+async def embed_texts(texts: List[str], client: httpx.AsyncClient, headers: dict) -> List[array]:
+    payload = {"model": OPENAI_EMBEDDING_MODEL, "input": texts}
+    resp = await client.post("/embeddings", headers=headers, json=payload)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail="OpenAI embeddings request failed")
+    data = sorted(orjson.loads(resp.content)["data"], key=lambda item: item["index"])
+    return [array("f", item["embedding"]) for item in data]
+
+def embedding_input(text: str) -> str:
+    data = text.encode("utf-8")
+    if len(data) <= EMBEDDING_MAX_BYTES:
+        return text
+    # "ignore" drops a multi-byte character split by the cut
+    return data[:EMBEDDING_MAX_BYTES].decode("utf-8", "ignore")
+
+def rank_paths(query: array, vectors: dict) -> List[str]:
+    # OpenAI embeddings are unit length, so the dot product is the cosine similarity
+    scores = {path: sum(map(operator.mul, query, vector)) for path, vector in vectors.items()}
+    return heapq.nlargest(RETRIEVAL_TOP_K, scores, key=scores.get)
+
+async def select_relevant_files(repo_files: dict, prompt: str, config: GitHubConfig, client: httpx.AsyncClient, headers: dict) -> dict:
+    if len(repo_files) <= RETRIEVAL_TOP_K:
+        return repo_files
+    # The path is part of the embedded text, so it is part of the key too;
+    # otherwise identical files (empty __init__.py, LICENSE) share one vector
+    keys = {path: (config.username, config.repo, path, git_blob_sha(content)) for path, content in repo_files.items()}
+    vectors = {}
+    missing = []
+    for path, key in keys.items():
+        vector = _embedding_cache.get(key)
+        if vector is None:
+            missing.append(path)
+        else:
+            vectors[path] = vector
+    sem = asyncio.Semaphore(OPENAI_CONCURRENCY)
+
+    async def embed_batch(paths: List[str]):
+        # Prefix the path so file names contribute to relevance
+        texts = [embedding_input(f"{path}\n{repo_files[path]}") for path in paths]
+        async with sem:
+            embeddings = await embed_texts(texts, client, headers)
+        for path, vector in zip(paths, embeddings):
+            vectors[path] = vector
+            _embedding_cache[keys[path]] = vector
+
+    batches = [missing[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(missing), EMBEDDING_BATCH_SIZE)]
+    query_vectors, *_ = await asyncio.gather(embed_texts([embedding_input(prompt)], client, headers), *(embed_batch(batch) for batch in batches))
+    # Scoring is pure-Python arithmetic over every file, keep it off the event loop
+    top_paths = await asyncio.to_thread(rank_paths, query_vectors[0], vectors)
+    return {path: repo_files[path] for path in top_paths}
+
+# Helper to convert an uploaded image to a low-res base64 string. Runs in a
+# worker process, so it must stay a picklable top-level function.
+def resize_and_encode(contents: bytes) -> Optional[str]:
+    try:
+        image = Image.open(io.BytesIO(contents))
+        max_size = (300, 300)
+        # Let libjpeg downscale during decode (no-op for other formats)
+        image.draft('RGB', max_size)
+        # Convert to RGB if needed
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        # Resize to max width or height 300px preserving aspect ratio
+        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+        # Encode once; if still over 50KB halve the dimensions (at most twice)
+        for attempt in range(3):
             buffer = io.BytesIO()
-            quality = 85
-            while True:
-                buffer.seek(0)
-                buffer.truncate(0)
-                image.save(buffer, format='JPEG', quality=quality)
-                size = buffer.tell()
-                if size <= 50 * 1024 or quality <= 20:
-                    break
-                quality -= 5
-            encoded = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            processed_files.append(encoded)
-        except Exception:
-            # Skip non-image or error files
-            continue
-    return processed_files
+            image.save(buffer, format='JPEG', quality=75, optimize=True, subsampling=2)
+            if buffer.tell() <= MAX_UPLOAD_IMAGE_SIZE or attempt == 2:
+                break
+            image = image.reduce(2)
+        return pybase64.b64encode(buffer.getvalue()).decode('utf-8')
+    except Exception:
+        # Skip non-image or error files
+        return None
+
+# Helper to convert uploaded images to low-res base64 strings, in parallel
+async def process_uploaded_files(files: List[UploadFile], pool: ProcessPoolExecutor) -> List[str]:
+    loop = asyncio.get_running_loop()
+
+    async def encode(file: UploadFile):
+        contents = await file.read()
+        # Small JPEGs are already in the target format; skip the PIL round-trip.
+        # The client's content type is not trusted, so check the SOI marker too.
+        if file.content_type == "image/jpeg" and len(contents) <= MAX_UPLOAD_IMAGE_SIZE and contents[:3] == b"\xff\xd8\xff":
+            return pybase64.b64encode(contents).decode('utf-8')
+        return await loop.run_in_executor(pool, resize_and_encode, contents)
+
+    results = await asyncio.gather(*(encode(file) for file in files))
+    return [encoded for encoded in results if encoded is not None]
 
 @app.post("/ask", response_model=AskResponse)
 async def ask_anything(
     ask_req: AskRequest,
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    user_secrets: models.UserSecrets = Depends(get_user_secrets),
+    db: AsyncSession = Depends(get_db),
+    gh_client: httpx.AsyncClient = Depends(get_github_client),
+    openai_client: httpx.AsyncClient = Depends(get_openai_client),
+    image_pool: ProcessPoolExecutor = Depends(get_image_pool),
     uploaded_files: Optional[List[UploadFile]] = File(None)
 ):
-    if not current_user.github_username or not current_user.github_repo or not current_user.github_token or not current_user.openai_token:
+    if not user_secrets.github_username or not user_secrets.github_repo or not user_secrets.github_token or not user_secrets.openai_token:
         raise HTTPException(status_code=400, detail="GitHub or OpenAI configuration incomplete")
+    # Nothing to match files against, and OpenAI rejects empty embedding inputs
+    if not ask_req.prompt.strip():
+        raise HTTPException(status_code=400, detail="Prompt is empty")
+
+    config = GitHubConfig(username=user_secrets.github_username, repo=user_secrets.github_repo, token=user_secrets.github_token)
 
-    config = GitHubConfig(username=current_user.github_username, repo=current_user.github_repo, token=current_user.github_token)
+    headers = {
+        "Authorization": f"Bearer {user_secrets.openai_token}",
+        "Content-Type": "application/json"
+    }
 
-    # Fetch repo files and contents
-    repo_files = await fetch_repo_files_contents(config)
+    # Fetch repo files and contents, keeping only those relevant to the prompt
+    repo_files = await fetch_repo_files_contents(config, gh_client)
+    repo_files = await select_relevant_files(repo_files, ask_req.prompt, config, openai_client, headers)
 
     # Process uploaded files if any
     encoded_files = []
     if uploaded_files:
-        encoded_files = await process_uploaded_files(uploaded_files)
-
-    # Prepare prompt for OpenAI
-    prompt_parts = ["You are a helpful assistant. Here are the repository files and their contents:"]
-    for path, content in repo_files.items():
-        prompt_parts.append(f"File: {path}\nContent:\n{content}\n---")
+        encoded_files = await process_uploaded_files(uploaded_files, image_pool)
 
-    if encoded_files:
-        prompt_parts.append("Here are some uploaded files encoded in base64 (JPEG, low-res):")
-        for idx, ef in enumerate(encoded_files):
-            prompt_parts.append(f"File {idx+1}: {ef}")
+    # Prepare prompt for OpenAI in a single pass (no intermediate list to join)
+    prompt_buf = io.StringIO()
+    prompt_buf.write("You are a helpful assistant. Here are the repository files most relevant to the request and their contents:\n")
+    for item in repo_files.items():
+        prompt_buf.write(PROMPT_FILE_TEMPLATE(item))
 
-    prompt_parts.append(f"User prompt: {ask_req.prompt}")
-    full_prompt = "\n".join(prompt_parts)
+    prompt_buf.write(f"User prompt: {ask_req.prompt}")
+    full_prompt = prompt_buf.getvalue()
 
-    # Call OpenAI API
-    headers = {
-        "Authorization": f"Bearer {current_user.openai_token}",
-        "Content-Type": "application/json"
-    }
+    # Uploaded images go in as image_url parts rather than base64 text in the prompt
+    user_content = [{"type": "text", "text": full_prompt}]
+    for ef in encoded_files:
+        user_content.append({
+            "type": "image_url",
+            "image_url": {"url": f"data:image/jpeg;base64,{ef}", "detail": "low"}
+        })
 
     # We use chat completion with system and user messages
     messages = [
         {"role": "system", "content": "You are a helpful assistant that returns JSON diffs of code changes."},
-        {"role": "user", "content": full_prompt}
+        {"role": "user", "content": user_content}
     ]
 
     payload = {
-        "model": "gpt-4",
+        "model": OPENAI_MODEL,
         "messages": messages,
         "temperature": 0
     }
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        resp = await client.post(OPENAI_API_URL, headers=headers, json=payload)
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail="OpenAI API request failed")
-        data = resp.json()
+    # Call OpenAI API
+    resp = await openai_client.post("/chat/completions", headers=headers, content=orjson.dumps(payload))
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail="OpenAI API request failed")
+    data = orjson.loads(resp.content)
 
     # Extract content
     try:
         content = data["choices"][0]["message"]["content"]
         # Expecting JSON array of diffs [{path, old, new}]
-        diffs_json = json.loads(content)
+        diffs_json = orjson.loads(content)
         diffs = [DiffItem(**item) for item in diffs_json]
     except Exception:
         # If parsing fails, return empty list
@@ -1,24 +1,176 @@
-from sqlalchemy import Column, Integer, String, DateTime
-from sqlalchemy.ext.declarative import declarative_base
-from datetime import datetime
+from sqlalchemy import DDL, BigInteger, CheckConstraint, String, DateTime, ForeignKey, Identity, Index, Integer, LargeBinary, UniqueConstraint, event, func, select, text, update
+from sqlalchemy.dialects.postgresql import CITEXT
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncSession
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+import threading
+import time
 
-Base = declarative_base()
+# 64-bit ids; SQLite only auto-increments an INTEGER PRIMARY KEY
+IdType = BigInteger().with_variant(Integer, "sqlite")
+
+# Case-insensitive text, so email equality uses the plain unique index.
+# 254 is the RFC 5321 maximum for an email address.
+CaseInsensitiveString = (
+    CITEXT()
+    .with_variant(String(254, collation="utf8mb4_0900_ai_ci"), "mysql")
+    .with_variant(String(254), "sqlite")
+)
+
+# AsyncAttrs adds awaitable_attrs, so lazy relationships load with an explicit
+# await instead of implicit IO (which AsyncSession cannot do)
+class Base(AsyncAttrs, DeclarativeBase):
+    pass
+
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS citext").execute_if(dialect="postgresql"),
+)
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # One index serves both uniqueness and the /refresh lookup: partial, so
+        # only users with a live session are stored, and covering, so the
+        # expiry and id are read straight from the index. MySQL ignores the
+        # WHERE clause and falls back to a full unique index.
+        Index(
+            "uq_users_refresh_token_active", "refresh_token",
+            unique=True,
+            postgresql_include=["refresh_token_expiry", "id"],
+            postgresql_where=text("refresh_token IS NOT NULL"),
+            mssql_where=text("refresh_token IS NOT NULL"),
+            mysql_length=32,
+        ),
+        CheckConstraint("(refresh_token IS NULL) = (refresh_token_expiry IS NULL)", name="ck_users_refresh_pair"),
+        UniqueConstraint("username", name="uq_users_username"),
+        # CITEXT has no length limit of its own
+        CheckConstraint("length(email) <= 254", name="ck_users_email_length"),
+        # text_pattern_ops lets PostgreSQL serve LIKE 'prefix%' lookups from the
+        # index regardless of the database collation. Elsewhere it would only
+        # duplicate uq_users_username, so it is PostgreSQL-only.
+        Index("ix_users_username_pattern", "username", postgresql_ops={"username": "text_pattern_ops"}).ddl_if(dialect="postgresql"),
+    )
+    # Server-generated timestamps are left expired after a flush rather than
+    # fetched back; nothing on the request path reads them
+    __mapper_args__ = {"eager_defaults": False, "confirm_deleted_rows": False}
+
+    id: Mapped[int] = mapped_column(IdType, Identity(always=False), primary_key=True)
+    # Stays case-sensitive text: nothing looks users up by username (login is
+    # by email), and a CITEXT column could not use the text_pattern_ops index
+    username: Mapped[str] = mapped_column(String(50))
+    email: Mapped[str] = mapped_column(CaseInsensitiveString, unique=True)
+    # Only login needs the hash; other loads skip it and raise if it is touched
+    hashed_password: Mapped[str] = mapped_column(String(60), deferred=True, deferred_group="auth_secret", deferred_raiseload=True)
+
+    refresh_token: Mapped[Optional[bytes]] = mapped_column(LargeBinary(32))  # raw SHA-256 digest
+    refresh_token_expiry: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    # Timestamps are computed by the database, not round-tripped from Python
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    @classmethod
+    async def invalidate_refresh(cls, session: AsyncSession, user_id: int) -> None:
+        token_hash = (await session.execute(select(cls.refresh_token).where(cls.id == user_id))).scalar_one_or_none()
+        if token_hash is not None:
+            cache_invalidate(token_hash)
+        await store_refresh_token(session, user_id, None, None)
+
+    # Credentials live in their own table so auth queries stay narrow; load
+    # them explicitly with `await user.awaitable_attrs.secrets`
+    secrets: Mapped[Optional["UserSecrets"]] = relationship(back_populates="user", passive_deletes=True)
+
+# Reserve free space per page so row updates on login/refresh can stay on the
+# same page. A DDL hook rather than postgresql_with, which SQLAlchemy only
+# accepts from 2.1 on.
+event.listen(
+    User.__table__,
+    "after_create",
+    DDL("ALTER TABLE users SET (fillfactor = 70)").execute_if(dialect="postgresql"),
+)
+
+class UserSecrets(Base):
+    __tablename__ = "user_secrets"
+
+    user_id: Mapped[int] = mapped_column(IdType, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+
+    # Widths follow GitHub's limits (39-char logins, 100-char repo names). Token
+    # formats vary in length (GitHub reserves up to 255), so those stay wide.
+    github_username: Mapped[Optional[str]] = mapped_column(String(39))
+    github_repo: Mapped[Optional[str]] = mapped_column(String(100))
+    github_token: Mapped[Optional[str]] = mapped_column(String(255))
+    openai_token: Mapped[Optional[str]] = mapped_column(String(255))
+
+    user: Mapped[User] = relationship(back_populates="secrets", lazy="raise")
+
+# Column-only rows for the login/refresh paths. Selecting plain columns skips
+# ORM instance construction and identity-map bookkeeping for a full User.
+
+class AuthRow(NamedTuple):
+    id: int
+    refresh_token_expiry: Optional[datetime]
+
+class LoginRow(NamedTuple):
+    id: int
+    hashed_password: str
+
+async def load_auth_row(session: AsyncSession, token_hash: bytes) -> Optional[AuthRow]:
+    # Both columns are covered by uq_users_refresh_token_active, so this can be index-only
+    stmt = select(User.id, User.refresh_token_expiry).where(User.refresh_token == token_hash)
+    row = (await session.execute(stmt)).one_or_none()
+    return AuthRow(*row) if row else None
+
+async def load_login_row(session: AsyncSession, email: str) -> Optional[LoginRow]:
+    stmt = select(User.id, User.hashed_password).where(User.email == email)
+    row = (await session.execute(stmt)).one_or_none()
+    return LoginRow(*row) if row else None
+
+async def store_refresh_token(session: AsyncSession, user_id: int, token_hash: Optional[bytes], expiry: Optional[datetime], current_hash: Optional[bytes] = None) -> bool:
+    stmt = update(User).where(User.id == user_id)
+    if current_hash is not None:
+        # Only replace the token the caller presented; a concurrent rotation or
+        # revoke (possibly seen by another process) makes this match no row
+        stmt = stmt.where(User.refresh_token == current_hash)
+    stmt = stmt.values(refresh_token=token_hash, refresh_token_expiry=expiry)
+    result = await session.execute(stmt)
+    return result.rowcount == 1
+
+# In-process cache of refresh-token lookups: SHA-256(token) -> (user_id,
+# expiry, cached_until). Entries live at most 5 minutes and never past the
+# token's expiry. Rotations and revokes are conditioned on the presented hash
+# in store_refresh_token, so a stale entry cannot revive a dead token.
+
+TOKEN_CACHE_MAX_SIZE = 10_000
+TOKEN_CACHE_TTL_SECONDS = 300
 
-    id = Column(Integer, primary_key=True, index=True)
-    username = Column(String(50), unique=True, index=True, nullable=False)
-    email = Column(String(255), unique=True, index=True, nullable=False)
-    hashed_password = Column(String(255), nullable=False)
+_token_cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+_token_cache_lock = threading.Lock()
 
-    github_username = Column(String(255), nullable=True)
-    github_repo = Column(String(255), nullable=True)
-    github_token = Column(String(255), nullable=True)
-    openai_token = Column(String(255), nullable=True)
+def cache_put(token_hash: bytes, user_id: int, expiry: datetime) -> None:
+    # Expiries are stored as naive UTC
+    expiry_ts = expiry.replace(tzinfo=timezone.utc).timestamp()
+    cached_until = min(expiry_ts, time.time() + TOKEN_CACHE_TTL_SECONDS)
+    with _token_cache_lock:
+        _token_cache[token_hash] = (user_id, expiry, cached_until)
+        _token_cache.move_to_end(token_hash)
+        while len(_token_cache) > TOKEN_CACHE_MAX_SIZE:
+            _token_cache.popitem(last=False)
 
-    refresh_token = Column(String(255), nullable=True, unique=True)
-    refresh_token_expiry = Column(DateTime, nullable=True)
+def cache_get(token_hash: bytes) -> Optional[AuthRow]:
+    with _token_cache_lock:
+        entry = _token_cache.get(token_hash)
+        if entry is None:
+            return None
+        if entry[2] <= time.time():
+            del _token_cache[token_hash]
+            return None
+        _token_cache.move_to_end(token_hash)
+    return AuthRow(entry[0], entry[1])
 
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+def cache_invalidate(token_hash: bytes) -> None:
+    with _token_cache_lock:
+        _token_cache.pop(token_hash, None)
@@ -16,19 +16,8 @@ then
     pip3 install alembic
 fi
 
-# Check if alembic.ini exists
-if [ ! -f alembic.ini ]; then
-    echo "Alembic configuration not found. Creating default alembic.ini and migration environment..."
-    alembic init alembic
-
-    # Modify alembic.ini to use DATABASE_URL environment variable
-    sed -i.bak 's#sqlalchemy.url = .*#sqlalchemy.url = ${DATABASE_URL}#' alembic.ini
-
-    # Create initial migration
-    alembic revision --autogenerate -m "Initial migration"
-fi
-
-# Run migrations
+# Run migrations (alembic.ini and alembic/ are in the repository; env.py
+# reads DATABASE_URL)
 alembic upgrade head
 
 echo "Database initialized and migrations applied successfully."
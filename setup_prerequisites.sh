@@ -56,6 +56,6 @@ fi
 # Install Python dependencies
 echo "Installing Python dependencies..."
 pip3 install --upgrade pip
-pip3 install fastapi uvicorn httpx sqlalchemy psycopg2-binary bcrypt PyJWT python-multipart
+pip3 install fastapi uvicorn "httpx[http2]" "sqlalchemy[asyncio]" psycopg2-binary asyncpg bcrypt PyJWT python-multipart cachetools orjson "pybase64>=1.3"
 
 echo "Setup complete. You can now run the application using ./start_backend.sh"